@@ -5,23 +5,104 @@ implementations based on `Curve25519 <https://cr.yp.to/ecdh.html>`__ and the
 """
 
 from __future__ import annotations
-from typing import Tuple, Union
+from typing import Any, Optional, OrderedDict, Tuple, Union
 import doctest
+import collections
 import hashlib
 import bcl
 import oblivious
 
+# All-zero nonce used when encrypting and decrypting messages.
+_ZERO_NONCE = bcl.nonce(bytes(bcl.nonce.length))
+
+# Encoding of the identity point.
+_IDENTITY = bytes(32)
+
+# Mask covering all bits of a 32-byte point encoding.
+_MASK_256 = (1 << 256) - 1
+
+_sha256 = hashlib.sha256 # pylint: disable=invalid-name
+
 def _hash(bs: bytes) -> bytes:
     """
     Generic hash function for hashing keys.
+
+    >>> _hash(bytes(32)).hex()
+    '66687aadf862bd776c8fc18b8e9f8e20089714856ee233b3902a591d0d5f2925'
+    """
+    return _sha256(bs).digest()
+
+def _enc(m: Union[bytes, bytearray], k: bcl.secret) -> bytes:
+    """
+    Encryption and encoding function for messages (the nonce is omitted
+    from the result).
+
+    >>> k = bcl.symmetric.secret()
+    >>> len(_enc(bytes(16), k))
+    32
     """
-    return hashlib.sha256(bs).digest()
+    return bcl.symmetric.encrypt(k, m, _ZERO_NONCE)[-32:]
+
+def _dec(c: Union[bytes, bytearray], k: bcl.secret) -> bytes:
+    """
+    Decryption and decoding function for messages.
+
+    >>> k = bcl.symmetric.secret()
+    >>> _dec(_enc(bytes([123]*16), k), k) == bytes([123]*16)
+    True
+    """
+    return bcl.symmetric.decrypt(k, bcl.cipher(_ZERO_NONCE + c))
+
+def _select(
+        bit: int,
+        point_zero: oblivious.ristretto.point,
+        point_one: oblivious.ristretto.point
+    ) -> oblivious.ristretto.point:
+    """
+    Select one of two points according to the supplied bit by masking
+    the point encodings (instead of branching on the bit).
+
+    >>> (p, q) = (oblivious.ristretto.point(), oblivious.ristretto.point())
+    >>> (_select(0, p, q) == p, _select(1, p, q) == q)
+    (True, True)
+    >>> isinstance(_select(1, p, q), oblivious.ristretto.point)
+    True
+    """
+    x_zero = int.from_bytes(point_zero, 'little')
+    x_one = int.from_bytes(point_one, 'little')
+    mask = -bit & _MASK_256
+    return oblivious.ristretto.point(
+        (x_zero ^ (mask & (x_zero ^ x_one))).to_bytes(32, 'little')
+    )
 
 class common:
     """
     Wrapper class for an object that maintains a party's
     state.
+
+    Symmetric keys derived from the public keys of the most recently seen
+    peers (up to :obj:`cache_size` of them) are cached within the instance,
+    so repeated transfers involving the same peer do not repeat the scalar
+    multiplication. The derived keys are deterministic functions of the two
+    parties' static keys, so caching them reveals nothing beyond what an
+    honest-but-curious party could recompute.
+
+    An instance may be shared across threads. Concurrent access to the
+    cache never causes a call to fail; at worst, a key is derived more
+    than once.
+    """
+    __slots__ = ('secret', 'public', '_k_cache', '__weakref__')
+
+    cache_size: int = 16
     """
+    Maximum number of peers for which derived symmetric keys are cached. A
+    receiver needs one entry per sender and a sender needs two entries per
+    receiver (one for each possible election bit), so the default covers a
+    handful of repeated peers. Servers that repeatedly interact with many
+    peers at once should increase this value (*e.g.*, on a subclass) and
+    a value of ``0`` disables caching.
+    """
+
     def __init__(self: common):
         # Secret key: x in Z/pZ.
         self.secret = oblivious.ristretto.scalar.random()
@@ -29,6 +110,55 @@ class common:
         # Public key: X = g^x.
         self.public = oblivious.ristretto.point.base(self.secret)
 
+        # Symmetric keys derived from peer public keys (indexed by encoding),
+        # ordered from least to most recently used.
+        self._k_cache: OrderedDict[bytes, Any] = collections.OrderedDict()
+
+    def _cache_get(self: common, key: bytes) -> Optional[Any]:
+        """
+        Retrieve the cached entry for a peer public key encoding (if it is
+        present) and mark it as the most recently used entry.
+
+        >>> (s, r) = (send(), receive())
+        >>> messages = s.reply(r.query(s.public, 1), bytes(16), bytes(16))
+        >>> r._cache_get(bytes(s.public)) is None
+        True
+        >>> _ = r.elect(s.public, 1, *messages)
+        >>> k_s = r._cache_get(bytes(s.public))
+        >>> _ = r.elect(s.public, 1, *messages)
+        >>> r._cache_get(bytes(s.public)) is k_s
+        True
+        """
+        value = self._k_cache.get(key)
+        if value is not None:
+            # The entry may have been evicted by another thread in the interim.
+            try:
+                self._k_cache.move_to_end(key)
+            except KeyError: # pragma: no cover
+                pass
+        return value
+
+    def _cache_put(self: common, key: bytes, value: Any):
+        """
+        Cache an entry for a peer public key encoding, evicting the least
+        recently used entries if the cache is full.
+
+        >>> c = common()
+        >>> for i in range(c.cache_size + 1):
+        ...     c._cache_put(bytes([i]), i)
+        >>> len(c._k_cache) == c.cache_size
+        True
+        >>> (c._cache_get(bytes([0])), c._cache_get(bytes([1])))
+        (None, 1)
+        """
+        self._k_cache[key] = value
+        while len(self._k_cache) > self.cache_size:
+            # Another thread may have emptied the cache in the interim.
+            try:
+                self._k_cache.popitem(last=False)
+            except KeyError: # pragma: no cover
+                break
+
 class receive(common):
     """
     Wrapper class for an object that maintains the receiving party's state and
@@ -38,6 +168,11 @@ class receive(common):
     >>> (len(r.secret), len(r.public))
     (32, 32)
     """
+    __slots__ = ()
+
+    # Decryption keys, indexed by sender public key encoding.
+    _k_cache: OrderedDict[bytes, bcl.secret]
+
     def query(
             self: receive,
             send_public: oblivious.ristretto.point,
@@ -71,7 +206,7 @@ class receive(common):
         if not isinstance(bit, int):
             raise TypeError('election bit must be an integer')
 
-        if not bit in [0, 1]:
+        if bit not in (0, 1):
             raise ValueError('election bit must be 0 or 1')
 
         # The sender's public key is A = g^a.
@@ -83,7 +218,9 @@ class receive(common):
         # Return B, where:
         # * if receiver's election bit is 0, B = g^b, and
         # * if receiver's election bit is 1, B = A * g^b.
-        return g_to_b if bit == 0 else g_to_a + g_to_b
+        # Both candidates are always computed and B is chosen using a mask
+        # (rather than a branch) on the election bit.
+        return _select(bit, g_to_b, g_to_a + g_to_b)
 
     def elect(
             self: receive,
@@ -129,7 +266,7 @@ class receive(common):
         if not isinstance(bit, int):
             raise TypeError('election bit must be an integer')
 
-        if not bit in [0, 1]:
+        if bit not in (0, 1):
             raise ValueError('election bit must be 0 or 1')
 
         # This is the receiver's secret key b.
@@ -138,14 +275,15 @@ class receive(common):
         # This is the sender's public key A = g^a.
         g_to_a: oblivious.ristretto.point = send_public
 
-        # Build the decryption key g^(ab).
-        k_s = bcl.secret(_hash(b * g_to_a))
-
-        # Decryption and decoding function.
-        dec = lambda c, k: bcl.symmetric.decrypt(k, bcl.cipher(bytes(24) + c))
+        # Build the decryption key g^(ab) (unless it was built previously).
+        key = bytes(g_to_a)
+        k_s = self._cache_get(key)
+        if k_s is None:
+            k_s = bcl.secret(_hash(b * g_to_a))
+            self._cache_put(key, k_s)
 
         # Decrypt the chosen message.
-        return dec(data_zero if bit == 0 else data_one, k_s)
+        return _dec(data_zero if bit == 0 else data_one, k_s)
 
 class send(common):
     """
@@ -156,6 +294,18 @@ class send(common):
     >>> (len(s.secret), len(s.public))
     (32, 32)
     """
+    __slots__ = ('_a_public',)
+
+    # Pairs of encryption keys, indexed by receiver public key encoding.
+    _k_cache: OrderedDict[bytes, Tuple[bcl.secret, bcl.secret]]
+
+    def __init__(self: send):
+        super().__init__()
+
+        # Public key multiplied by the secret key, A^a, which is reused by
+        # every reply (computed upon the first reply that derives keys).
+        self._a_public: Optional[oblivious.ristretto.point] = None
+
     def reply(
             self: send,
             receive_public: oblivious.ristretto.point,
@@ -190,6 +340,18 @@ class send(common):
         Traceback (most recent call last):
           ...
         ValueError: each message must be of length 16
+        >>> rsp = s.reply(r.public, bytes([123]*16),  bytes([234]))
+        Traceback (most recent call last):
+          ...
+        ValueError: each message must be of length 16
+
+        The receiver public key cannot be the sender's own public key (as
+        the key for the second message would then be publicly known).
+
+        >>> rsp = s.reply(s.public, bytes([123]*16),  bytes([234]*16))
+        Traceback (most recent call last):
+          ...
+        ValueError: receiver public key must not equal sender public key
         """
         if (
             not isinstance(data_zero, (bytes, bytearray)) or
@@ -197,30 +359,70 @@ class send(common):
         ):
             raise TypeError('each message must be a bytes-like object')
 
-        if len(data_zero) != 16 or len(data_zero) != 16:
+        if len(data_zero) != 16 or len(data_one) != 16:
             raise ValueError('each message must be of length 16')
 
-        # These are the sender's secret and public keys.
-        a: oblivious.ristretto.scalar = self.secret
-        g_to_a: oblivious.ristretto.point = self.public
+        # Build the keys for the messages for the zero and one cases.
+        (k_0, k_1) = self._derive_keys(receive_public)
 
-        # Second argument is receiver's public key B_s, which depends on
-        # the receiver's election bit s and is B_0 = g^b or B_1 = A * g^b.
-        B_s: oblivious.ristretto.point = receive_public # pylint: disable=invalid-name
+        # Encrypt the two messages.
+        return (_enc(data_zero, k_0), _enc(data_one, k_1))
 
-        # Build the key for the message for the zero case.
-        k_0 = bcl.secret(_hash(a * B_s))
+    def _derive_keys(
+            self: send,
+            receive_public: oblivious.ristretto.point
+        ) -> Tuple[bcl.secret, bcl.secret]:
+        """
+        Derive the pair of symmetric keys used to encrypt the two data
+        messages in a reply to the supplied receiver public key.
 
-        # Build the key for the message for the one case.
-        k_1 = bcl.secret(_hash(a * (B_s - g_to_a)))
+        >>> (s, r) = (send(), receive())
+        >>> s._a_public is None
+        True
+        >>> (k_0, k_1) = s._derive_keys(r.query(s.public, 0))
+        >>> s._a_public == s.secret * s.public
+        True
+        >>> k_0 == bcl.secret(_hash(r.secret * s.public))
+        True
+        >>> (k_0, k_1) = s._derive_keys(r.query(s.public, 1))
+        >>> k_1 == bcl.secret(_hash(r.secret * s.public))
+        True
 
-        # Encryption and encoding function.
-        enc = lambda m, k: (
-            bcl.symmetric.encrypt(k, m, bcl.nonce(bcl.nonce.length))[-32:]
-        )
+        Keys derived for a receiver public key are cached and reused on later
+        calls.
 
-        # Encrypt the two messages.
-        return (enc(data_zero, k_0), enc(data_one, k_1))
+        >>> p = r.query(s.public, 1)
+        >>> s._derive_keys(p) is s._derive_keys(p)
+        True
+        """
+        keys = self._cache_get(bytes(receive_public))
+        if keys is not None:
+            return keys
+
+        # These are the sender's secret key and the point A^a.
+        a: oblivious.ristretto.scalar = self.secret
+        A_to_a: oblivious.ristretto.point = self._a_public # pylint: disable=invalid-name
+        if A_to_a is None:
+            A_to_a = self._a_public = a * self.public # pylint: disable=invalid-name
+
+        # Argument is receiver's public key B_s, which depends on the
+        # receiver's election bit s and is B_0 = g^b or B_1 = A * g^b.
+        B_s: oblivious.ristretto.point = receive_public # pylint: disable=invalid-name
+
+        # Build the key for the message for the zero case.
+        B_s_to_a = a * B_s # pylint: disable=invalid-name
+        k_0 = bcl.secret(_hash(B_s_to_a))
+
+        # Build the key for the message for the one case, reusing the scalar
+        # multiplication above since (B_s / A)^a = B_s^a / A^a. If B_s = A,
+        # this is the identity point and the key would be publicly known.
+        B_s_over_A_to_a = B_s_to_a - A_to_a # pylint: disable=invalid-name
+        if B_s_over_A_to_a == _IDENTITY:
+            raise ValueError('receiver public key must not equal sender public key')
+        k_1 = bcl.secret(_hash(B_s_over_A_to_a))
+
+        self._cache_put(bytes(B_s), (k_0, k_1))
+        return (k_0, k_1)
 
 if __name__ == '__main__':
     doctest.testmod() # pragma: no cover